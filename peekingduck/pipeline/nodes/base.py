@@ -14,20 +14,128 @@
 
 """Mixin classes for PeekingDuck nodes and models."""
 
+import functools
 import hashlib
+import json
+import mmap
 import operator
 import os
 import re
+import shutil
 import sys
+import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Set, Union
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
+import numpy as np
 import requests
 from tqdm import tqdm
+from tqdm.utils import CallbackIOWrapper
 
 BASE_URL = "https://storage.googleapis.com/peekingduck/models"
 PEEKINGDUCK_WEIGHTS_SUBDIR = "peekingduck_weights"
+WEIGHTS_CHECKSUMS_FILENAME = "weights_checksums.json"
+WEIGHTS_CHECKSUMS_TIMEOUT = 10
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_NUM_WORKERS = 8
+DOWNLOAD_PART_MIN_SIZE = 8 * 1024 * 1024
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+SHA256_BUFFER_SIZE = 4 * 1024 * 1024
+SHA256_MMAP_MIN_SIZE = 16 * 1024 * 1024
+SHA256_MMAP_MAX_SIZE_WINDOWS = 2 * 1024 * 1024 * 1024
+SHA256_CACHE_SUFFIX = ".sha256.json"
+VECTORIZED_COMPARE_MIN_LENGTH = 8
+INTERVAL_PATTERN = re.compile(
+    r"^[\[\(]\s*[-+]?(inf|\d*\.?\d+)\s*,\s*[-+]?(inf|\d*\.?\d+)\s*[\]\)]$"
+)
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_interval(interval: str) -> Tuple[float, float, Callable, Callable, str]:
+    """Parses a mathematical interval string into its bounds and the
+    comparison methods to check against each bound. Results are cached as the
+    same interval strings are typically checked by many nodes.
+
+    Args:
+        interval (str): An mathematical interval representing the range of
+            valid values, see `ThresholdCheckerMixin.check_bounds()`.
+
+    Returns:
+        (Tuple[float, float, Callable, Callable, str]): The lower bound, the
+        upper bound, the comparison methods for the lower and upper bounds,
+        and the failure reason.
+
+    Raises:
+        ValueError: If `interval` does not match the specified format.
+        ValueError: If the lower bound is larger than the upper bound.
+    """
+    if INTERVAL_PATTERN.match(interval) is None:
+        raise ValueError("Badly formatted interval")
+
+    left_bracket = interval[0]
+    right_bracket = interval[-1]
+    lower, upper = [float(value.strip()) for value in interval[1:-1].split(",")]
+
+    if lower > upper:
+        raise ValueError("Lower bound cannot be larger than upper bound")
+
+    method_lower = operator.ge if left_bracket == "[" else operator.gt
+    method_upper = operator.le if right_bracket == "]" else operator.lt
+    reason = f"between {left_bracket}{lower}, {upper}{right_bracket}"
+    return lower, upper, method_lower, method_upper, reason
+
+
+def _flatten_keys(key: Union[str, List[Any]]) -> List[str]:
+    """Flattens `key`, which may be a str or an arbitrarily nested list of
+    str, into a flat list of keys.
+
+    Args:
+        key (Union[str, List[Any]]): The specified key or list of keys.
+
+    Returns:
+        (List[str]): The flattened list of keys.
+
+    Raises:
+        TypeError: `key`, or any of its nested elements, is not in
+            (List[str], str).
+    """
+    keys = []
+    stack = [key]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            keys.append(item)
+        elif isinstance(item, list):
+            stack.extend(reversed(item))
+        else:
+            raise TypeError("`key` must be either str or list")
+    return keys
+
+
+def _to_numeric_array(values: List[Any]) -> Optional[np.ndarray]:
+    """Converts a long list of numbers to a 1-D NumPy array so it can be
+    compared against a bound in a single vectorized operation.
+
+    Args:
+        values (List[Any]): The list of configuration values.
+
+    Returns:
+        (Optional[np.ndarray]): The converted array, or ``None`` if `values`
+        is too short to benefit from vectorization, is nested, or contains
+        non-numeric elements. Such lists should be compared element-wise so
+        that invalid elements raise the same errors as short lists.
+    """
+    if len(values) <= VECTORIZED_COMPARE_MIN_LENGTH:
+        return None
+    try:
+        array = np.asarray(values)
+    except ValueError:  # ragged nested lists
+        return None
+    if array.ndim != 1 or not np.issubdtype(array.dtype, np.number):
+        return None
+    return array
 
 
 class ThresholdCheckerMixin:
@@ -35,10 +143,6 @@ class ThresholdCheckerMixin:
     values, typically thresholds.
     """
 
-    interval_pattern = re.compile(
-        r"^[\[\(]\s*[-+]?(inf|\d*\.?\d+)\s*,\s*[-+]?(inf|\d*\.?\d+)\s*[\]\)]$"
-    )
-
     def check_bounds(self, key: Union[str, List[str]], interval: str) -> None:
         """Checks if the configuration value(s) specified by `key` satisfies
         the specified bounds.
@@ -93,17 +197,9 @@ class ThresholdCheckerMixin:
             | (lower, upper)      | lower < config[key] < upper         |
             +---------------------+-------------------------------------+
         """
-        if self.interval_pattern.match(interval) is None:
-            raise ValueError("Badly formatted interval")
-
-        left_bracket = interval[0]
-        right_bracket = interval[-1]
-        lower, upper = [float(value.strip()) for value in interval[1:-1].split(",")]
-
-        if lower > upper:
-            raise ValueError("Lower bound cannot be larger than upper bound")
-
-        self._check_within_bounds(key, lower, upper, left_bracket, right_bracket)
+        lower, upper, method_lower, method_upper, reason = _parse_interval(interval)
+        self._compare(key, lower, method_lower, reason)
+        self._compare(key, upper, method_upper, reason)
 
     def check_valid_choice(
         self, key: str, choices: Set[Union[int, float, str]]
@@ -124,37 +220,6 @@ class ThresholdCheckerMixin:
         if self.config[key] not in choices:
             raise ValueError(f"{key} must be one of {choices}")
 
-    def _check_within_bounds(  # pylint: disable=too-many-arguments
-        self,
-        key: Union[str, List[str]],
-        lower: float,
-        upper: float,
-        left_bracket: str,
-        right_bracket: str,
-    ) -> None:
-        """Checks that configuration values specified by `key` is within the
-        specified bounds between `lower` and `upper`.
-
-        Args:
-            key (Union[str, List[str]]): The specified key or list of keys.
-            lower (float): The lower bound.
-            upper (float): The upper bound.
-            left_bracket (str): Either a "(" for an open lower bound or a "["
-                for a closed lower bound.
-            right_bracket (str): Either a ")" for an open upper bound or a "]"
-                for a closed upper bound.
-
-        Raises:
-            TypeError: `key` type is not in (List[str], str).
-            ValueError: If the configuration value is not between `lower` and
-                `upper`.
-        """
-        method_lower = operator.ge if left_bracket == "[" else operator.gt
-        method_upper = operator.le if right_bracket == "]" else operator.lt
-        reason = f"between {left_bracket}{lower}, {upper}{right_bracket}"
-        self._compare(key, lower, method_lower, reason)
-        self._compare(key, upper, method_upper, reason)
-
     def _compare(
         self,
         key: Union[str, List[str]],
@@ -178,22 +243,38 @@ class ThresholdCheckerMixin:
             ValueError: If the comparison between `config[key]` and `value`
                 fails.
         """
-        if isinstance(key, str):
-            if isinstance(self.config[key], list):
-                if not all(method(val, value) for val in self.config[key]):
-                    raise ValueError(f"All elements of {key} must be {reason}")
-            elif not method(self.config[key], value):
-                raise ValueError(f"{key} must be {reason}")
-        elif isinstance(key, list):
-            for k in key:
-                self._compare(k, value, method, reason)
-        else:
-            raise TypeError("`key` must be either str or list")
+        config = self.config
+        for k in _flatten_keys(key):
+            config_value = config[k]
+            if isinstance(config_value, list):
+                numeric_array = _to_numeric_array(config_value)
+                if numeric_array is not None:
+                    is_valid = method(numeric_array, value).all()
+                else:
+                    is_valid = all(method(val, value) for val in config_value)
+                if not is_valid:
+                    raise ValueError(f"All elements of {k} must be {reason}")
+            elif not method(config_value, value):
+                raise ValueError(f"{k} must be {reason}")
 
 
 class WeightsDownloaderMixin:
     """Mixin class providing utility methods for downloading model weights."""
 
+    # Weights checksums shared by all model nodes, keyed by the checksums URL
+    _weights_checksums_cache: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def requests_session(self) -> requests.Session:
+        """HTTP session shared by the weights and checksum downloads so the
+        connection to the weights server is reused. ``requests`` does not
+        guarantee that a ``Session`` is thread-safe, so the parallel range
+        downloads each use a session of their own instead.
+        """
+        if getattr(self, "_requests_session", None) is None:
+            self._requests_session = requests.Session()
+        return self._requests_session
+
     @property
     def blob_filename(self) -> str:
         """Name of the selected weights on GCP."""
@@ -247,22 +328,145 @@ class WeightsDownloaderMixin:
 
         return model_dir
 
+    def _cached_sha256(self, path: Path) -> str:
+        """Returns the SHA256 hex digest of the specified weights
+        file/directory. The digest is cached in a sidecar JSON file next to
+        the weights and is only recomputed when the size or modification time
+        of the weights changes.
+
+        Args:
+            path (Path): Path to the weights file/directory.
+
+        Returns:
+            (str): The SHA256 hex digest of the weights.
+        """
+        cache_path = path.with_name(f"{path.name}{SHA256_CACHE_SUFFIX}")
+        mtime, size = self._stat_weights(path)
+        try:
+            with open(cache_path) as infile:
+                cache = json.load(infile)
+            if cache["mtime"] == mtime and cache["size"] == size:
+                return cache["sha256"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        digest = self.sha256sum(path).hexdigest()
+        try:
+            self._write_json(
+                cache_path, {"mtime": mtime, "size": size, "sha256": digest}
+            )
+        except OSError:
+            self.logger.debug(f"Unable to write checksum cache to {cache_path}")
+        return digest
+
     def _download_to(self, filename: str, destination_dir: Path) -> None:
         """Downloads publicly shared files from Google Cloud Platform.
 
-        Saves download content in chunks. Chunk size set to large integer as
-        weights are usually pretty large.
+        Copies the raw response stream to file in chunks. Chunk size set to
+        large integer as weights are usually pretty large. Large files are
+        downloaded as multiple byte ranges in parallel when the server
+        supports it.
 
         Args:
+            filename (str): Name of the file to download.
             destination_dir (Path): Destination directory of downloaded file.
         """
-        with open(destination_dir / filename, "wb") as outfile, requests.get(
-            f"{BASE_URL}/{self.model_subdir}/{self.config['model_format']}/{filename}",
-            stream=True,
+        url = f"{BASE_URL}/{self.model_subdir}/{self.config['model_format']}/{filename}"
+        file_path = destination_dir / filename
+        with self.requests_session.head(url, allow_redirects=True) as response:
+            file_size = int(response.headers.get("Content-Length", 0))
+            accepts_ranges = response.headers.get("Accept-Ranges") == "bytes"
+
+        if (
+            accepts_ranges
+            and file_size >= 2 * DOWNLOAD_PART_MIN_SIZE
+            and self._download_parts(url, file_path, file_size)
+        ):
+            return
+
+        with self.requests_session.get(url, stream=True) as response, open(
+            file_path, "wb"
+        ) as outfile, tqdm.wrapattr(
+            outfile, "write", total=file_size or None
+        ) as progress_outfile:
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, progress_outfile, DOWNLOAD_CHUNK_SIZE)
+
+    def _download_part(
+        self, url: str, file_path: Path, byte_range: Tuple[int, int], progress: tqdm
+    ) -> bool:
+        """Downloads the specified byte range of `url` and writes it to the
+        same offset in the pre-allocated file at `file_path`.
+
+        Args:
+            url (str): URL of the file to download.
+            file_path (Path): Path to the pre-allocated destination file.
+            byte_range (Tuple[int, int]): The first and last byte positions
+                (inclusive) to download.
+            progress (tqdm): Progress bar shared by all parts.
+
+        Returns:
+            (bool): ``True`` if the server returned exactly the requested
+            range, else ``False``.
+        """
+        start, end = byte_range
+        num_written = 0
+
+        def _update_progress(num_bytes: int) -> None:
+            nonlocal num_written
+            num_written += num_bytes
+            progress.update(num_bytes)
+
+        with requests.Session() as session, session.get(
+            url, headers={"Range": f"bytes={start}-{end}"}, stream=True
         ) as response:
-            for chunk in tqdm(response.iter_content(chunk_size=32768)):
-                if chunk:  # filter out keep-alive new chunks
-                    outfile.write(chunk)
+            if response.status_code != 206 or not response.headers.get(
+                "Content-Range", ""
+            ).startswith(f"bytes {start}-{end}/"):
+                return False
+            with open(file_path, "r+b") as outfile:
+                outfile.seek(start)
+                response.raw.decode_content = True
+                shutil.copyfileobj(
+                    response.raw,
+                    CallbackIOWrapper(_update_progress, outfile, "write"),
+                    DOWNLOAD_CHUNK_SIZE,
+                )
+        return num_written == end - start + 1
+
+    def _download_parts(self, url: str, file_path: Path, file_size: int) -> bool:
+        """Downloads `url` to `file_path` as multiple byte ranges over
+        parallel connections.
+
+        Args:
+            url (str): URL of the file to download.
+            file_path (Path): Path to the destination file.
+            file_size (int): Size of the file in bytes.
+
+        Returns:
+            (bool): ``True`` if all byte ranges were downloaded, ``False`` if
+            the server did not honour the range requests or returned
+            incomplete ranges.
+        """
+        num_parts = min(DOWNLOAD_NUM_WORKERS, file_size // DOWNLOAD_PART_MIN_SIZE)
+        part_size = -(-file_size // num_parts)
+        byte_ranges = [
+            (start, min(start + part_size, file_size) - 1)
+            for start in range(0, file_size, part_size)
+        ]
+        with open(file_path, "wb") as outfile:
+            outfile.truncate(file_size)
+
+        with tqdm(
+            total=file_size, unit="B", unit_scale=True
+        ) as progress, ThreadPoolExecutor(max_workers=num_parts) as executor:
+            results = executor.map(
+                lambda byte_range: self._download_part(
+                    url, file_path, byte_range, progress
+                ),
+                byte_ranges,
+            )
+            return all(list(results))
 
     def _extract_file(self, destination_dir: Path) -> None:
         """Extracts the zip file to ``destination_dir``.
@@ -272,12 +476,48 @@ class WeightsDownloaderMixin:
         """
         zip_path = destination_dir / self.blob_filename
         with zipfile.ZipFile(zip_path, "r") as infile:
-            file_list = infile.namelist()
-            for file in tqdm(file=sys.stdout, iterable=file_list, total=len(file_list)):
-                infile.extract(member=file, path=destination_dir)
+            member_list = infile.infolist()
+            for member in tqdm(
+                file=sys.stdout, iterable=member_list, total=len(member_list)
+            ):
+                self._extract_member(infile, member, destination_dir)
 
         os.remove(zip_path)
 
+    @staticmethod
+    def _extract_member(
+        infile: zipfile.ZipFile, member: zipfile.ZipInfo, destination_dir: Path
+    ) -> None:
+        """Extracts a single zip file member to ``destination_dir``, copying
+        it in large chunks. Like ``ZipFile.extract()``, the drive letter and
+        empty, "." and ".." path components are dropped.
+
+        Args:
+            infile (zipfile.ZipFile): The opened zip file.
+            member (zipfile.ZipInfo): The member to extract.
+            destination_dir (Path): Destination directory for extraction.
+
+        Raises:
+            ValueError: If the member would be extracted outside of
+                ``destination_dir``.
+        """
+        arcname = os.path.splitdrive(member.filename)[1]
+        target_path = destination_dir.joinpath(
+            *[part for part in arcname.split("/") if part not in {"", ".", ".."}]
+        )
+        resolved_dir = destination_dir.resolve()
+        resolved_path = target_path.resolve()
+        if resolved_path != resolved_dir and resolved_dir not in resolved_path.parents:
+            raise ValueError(
+                f"Zip member {member.filename} is outside of {destination_dir}"
+            )
+        if member.is_dir():
+            target_path.mkdir(parents=True, exist_ok=True)
+            return
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        with infile.open(member) as source, open(target_path, "wb") as outfile:
+            shutil.copyfileobj(source, outfile, EXTRACT_BUFFER_SIZE)
+
     def _find_paths(self) -> Path:
         """Constructs the `peekingduck_weights` directory path and the model
         sub-directory path.
@@ -313,9 +553,54 @@ class WeightsDownloaderMixin:
             / self.config["model_format"]
         )
 
+    def _fetch_weights_checksums(self, checksums_url: str) -> Dict[str, Any]:
+        """Fetches the weights checksums from ``checksums_url`` and keeps a
+        local copy in the PeekingDuck weights directory. The local copy is
+        used instead when the weights server cannot be reached.
+
+        Args:
+            checksums_url (str): URL of the weights checksums file.
+
+        Returns:
+            (Dict[str, Any]): Weights checksums of all models.
+
+        Raises:
+            requests.ConnectionError: When the weights server cannot be
+                reached and there is no readable local copy of the checksums.
+            requests.Timeout: When the weights server does not respond in
+                time and there is no readable local copy of the checksums.
+        """
+        local_path = self._find_paths().parents[1] / WEIGHTS_CHECKSUMS_FILENAME
+        try:
+            with self.requests_session.get(
+                checksums_url, timeout=WEIGHTS_CHECKSUMS_TIMEOUT
+            ) as response:
+                checksums = response.json()
+        except (requests.ConnectionError, requests.Timeout) as error:
+            try:
+                with open(local_path) as infile:
+                    checksums = json.load(infile)
+            except (OSError, ValueError):
+                raise error from None
+            self.logger.warning(
+                "Unable to reach weights server, using weights checksums from "
+                f"{local_path}."
+            )
+            return checksums
+
+        try:
+            self._write_json(local_path, checksums)
+        except OSError:
+            self.logger.debug(f"Unable to write weights checksums to {local_path}")
+        return checksums
+
     def _get_weights_checksum(self) -> str:
-        with requests.get(f"{BASE_URL}/weights_checksums.json") as response:
-            checksums = response.json()
+        checksums_url = f"{BASE_URL}/{WEIGHTS_CHECKSUMS_FILENAME}"
+        if checksums_url not in self._weights_checksums_cache:
+            self._weights_checksums_cache[
+                checksums_url
+            ] = self._fetch_weights_checksums(checksums_url)
+        checksums = self._weights_checksums_cache[checksums_url]
         self.logger.debug(f"weights_checksums: {checksums[self.model_subdir]}")
         return checksums[self.model_subdir][self.config["model_format"]][
             str(self.config["model_type"])
@@ -337,15 +622,71 @@ class WeightsDownloaderMixin:
         if not weights_path.exists():
             self.logger.warning("No weights detected.")
             return False
-        if self.sha256sum(weights_path).hexdigest() != self._get_weights_checksum():
+        if self._cached_sha256(weights_path) != self._get_weights_checksum():
             self.logger.warning("Weights file is corrupted/out-of-date.")
             return False
         return True
 
+    @staticmethod
+    def _stat_weights(path: Path) -> Tuple[int, int]:
+        """Computes the latest modification time and the total size of the
+        specified file/directory. Files ignored by `sha256sum()` are skipped.
+
+        Args:
+            path (Path): Path to the weights file/directory.
+
+        Returns:
+            (Tuple[int, int]): The latest modification time in nanoseconds
+            and the total size in bytes.
+        """
+        stat = path.stat()
+        mtime = stat.st_mtime_ns
+        size = 0
+        if path.is_dir():
+            for subpath in path.iterdir():
+                if subpath.name not in {".DS_Store", "__MACOSX"}:
+                    sub_mtime, sub_size = WeightsDownloaderMixin._stat_weights(subpath)
+                    mtime = max(mtime, sub_mtime)
+                    size += sub_size
+        else:
+            size = stat.st_size
+        return mtime, size
+
+    @staticmethod
+    def _write_json(path: Path, data: Dict[str, Any]) -> None:
+        """Writes `data` as JSON to `path` via a temporary file in the same
+        directory, so an interrupted write never leaves a truncated file
+        behind. The file is given the same umask-derived permissions as a
+        file created with ``open()``.
+
+        Args:
+            path (Path): Path to the JSON file.
+            data (Dict[str, Any]): The data to be written.
+
+        Raises:
+            OSError: If the file cannot be written.
+        """
+        # os.umask() can only be read by setting it
+        umask = os.umask(0)
+        os.umask(umask)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False
+        ) as outfile:
+            tmp_path = outfile.name
+        try:
+            with open(tmp_path, "w") as outfile:
+                json.dump(data, outfile)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
     @staticmethod
     def sha256sum(path: Path, hash_func: "hashlib._Hash" = None) -> "hashlib._Hash":
-        """Hashes the specified file/directory using SHA256. Reads the file in
-        chunks to be more memory efficient.
+        """Hashes the specified file/directory using SHA256. Large files are
+        memory-mapped and hashed without copying, other files are read in
+        chunks into a reusable buffer to be more memory efficient.
 
         When a directory path is passed as the argument, sort the folder
         content and hash the content recursively.
@@ -366,8 +707,20 @@ class WeightsDownloaderMixin:
                 if subpath.name not in {".DS_Store", "__MACOSX"}:
                     hash_func = WeightsDownloaderMixin.sha256sum(subpath, hash_func)
         else:
-            buffer_size = hash_func.block_size * 1024
+            file_size = path.stat().st_size
             with open(path, "rb") as infile:
-                for chunk in iter(lambda: infile.read(buffer_size), b""):
-                    hash_func.update(chunk)
+                if SHA256_MMAP_MIN_SIZE < file_size and (
+                    os.name != "nt" or file_size <= SHA256_MMAP_MAX_SIZE_WINDOWS
+                ):
+                    with mmap.mmap(
+                        infile.fileno(), 0, access=mmap.ACCESS_READ
+                    ) as mapped_file:
+                        hash_func.update(mapped_file)
+                else:
+                    # Don't allocate more than needed for small files, e.g.,
+                    # the many small files in a SavedModel directory
+                    buffer = bytearray(min(file_size, SHA256_BUFFER_SIZE))
+                    view = memoryview(buffer)
+                    for num_bytes in iter(lambda: infile.readinto(buffer), 0):
+                        hash_func.update(view[:num_bytes])
         return hash_func
@@ -95,6 +95,9 @@ class Detector:  # pylint: disable=too-few-public-methods,too-many-instance-attr
             inputs=self.model_nodes["inputs"],
             outputs=self.model_nodes["outputs"],
         )
+        # Run a blank frame through the graph so one-off initialization, such
+        # as cuDNN algorithm autotuning, does not delay the first real frame
+        model(x=tf.zeros((1, self.image_size, self.image_size, 3), dtype=tf.float32))
         self.logger.info(
             "EfficientDet model loaded with following configs:\n\t"
             f"Model type: D{self.model_type}\n\t"
@@ -124,22 +127,17 @@ class Detector:  # pylint: disable=too-few-public-methods,too-many-instance-attr
         """
         img_h, img_w = img_shape
         boxes, scores, labels = network_output
-        boxes = postprocess_boxes(boxes, scale, img_h, img_w)
 
-        # Filter by confidence score
-        score_filter = np.where(scores[:] > self.score_threshold)[0]
-        boxes = boxes[score_filter]
-        labels = labels[score_filter]
-        scores = scores[score_filter]
-
-        # Filter by detect ID
-        detect_filter = np.where(np.isin(labels, self.detect_ids))
-        boxes = boxes[detect_filter]
+        # Filter by confidence score and detect ID
+        detect_filter = (scores > self.score_threshold) & np.isin(
+            labels, self.detect_ids
+        )
+        boxes = postprocess_boxes(boxes[detect_filter], scale, img_h, img_w)
         labels = labels[detect_filter]
         scores = scores[detect_filter]
 
         if labels.size:
-            labels = np.vectorize(self.class_names.get)(labels)
+            labels = np.array([self.class_names.get(label) for label in labels])
         return boxes, labels, scores
 
     def _preprocess(self, image: np.ndarray) -> Tuple[np.ndarray, float]:
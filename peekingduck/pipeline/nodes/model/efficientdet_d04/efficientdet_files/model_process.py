@@ -26,6 +26,9 @@ import numpy as np
 
 IMG_MEAN = [0.485, 0.456, 0.406]
 IMG_STD = [0.229, 0.224, 0.225]
+# (image / 255 - IMG_MEAN) / IMG_STD folded into image * IMG_SCALE - IMG_OFFSET
+IMG_SCALE = (1.0 / (255.0 * np.array(IMG_STD))).astype(np.float32)
+IMG_OFFSET = (np.array(IMG_MEAN) / np.array(IMG_STD)).astype(np.float32)
 
 
 def preprocess_image(
@@ -53,15 +56,13 @@ def preprocess_image(
         resized_width = image_size
 
     image = cv2.resize(image, (resized_width, resized_height))
-    image = image.astype(np.float32)
-    image /= 255.0
-    image -= IMG_MEAN
-    image /= IMG_STD
-    pad_h = image_size - resized_height
-    pad_w = image_size - resized_width
-    image = np.pad(image, [(0, pad_h), (0, pad_w), (0, 0)], mode="constant")
+    # Normalize directly into the top-left of the zero-padded output
+    padded_image = np.zeros((image_size, image_size, 3), dtype=np.float32)
+    normalized_image = padded_image[:resized_height, :resized_width]
+    np.multiply(image, IMG_SCALE, out=normalized_image)
+    normalized_image -= IMG_OFFSET
 
-    return image, scale
+    return padded_image, scale
 
 
 def postprocess_boxes(
@@ -25,7 +25,13 @@ def threshold_model():
 
 class ThresholdModel(ThresholdCheckerMixin):
     def __init__(self):
-        self.config = {"a": 12.5, "b": 10, "c": "value", "d": [10, 12.5, 13]}
+        self.config = {
+            "a": 12.5,
+            "b": 10,
+            "c": "value",
+            "d": [10, 12.5, 13],
+            "e": [10 + 0.25 * i for i in range(20)],
+        }
 
 
 class TestThresholdCheckerMixin:
@@ -34,6 +40,18 @@ class TestThresholdCheckerMixin:
             threshold_model.check_bounds({"key1": "a"}, "[10, +inf]")
         assert "`key` must be either str or list" == str(excinfo.value)
 
+    @pytest.mark.parametrize("key", [[1], ["a", None], [["a", 1.0]]])
+    def test_check_bounds_invalid_list_key_type(self, threshold_model, key):
+        with pytest.raises(TypeError) as excinfo:
+            threshold_model.check_bounds(key, "[0, +inf]")
+        assert "`key` must be either str or list" == str(excinfo.value)
+
+    def test_check_bounds_nested_list_key(self, threshold_model):
+        threshold_model.check_bounds([["a", ["b"]], "d"], "[0, +inf]")
+        with pytest.raises(ValueError) as excinfo:
+            threshold_model.check_bounds([["a", ["b"]]], "[13, +inf]")
+        assert "a must be between [13.0, inf]" == str(excinfo.value)
+
     def test_check_bounds_bad_format(self, threshold_model):
         with pytest.raises(ValueError) as excinfo:
             # missing separator
@@ -294,6 +312,29 @@ class TestThresholdCheckerMixin:
             threshold_model.check_bounds(["a", "b"], "[9, 11]")
         assert "a must be between [9.0, 11.0]" == str(excinfo.value)
 
+    def test_threshold_within_bounds_long_list(self, threshold_model):
+        with not_raises(ValueError):
+            threshold_model.check_bounds("e", "[10, 14.75]")
+            threshold_model.check_bounds(["d", "e"], "[10, 15)")
+
+        with pytest.raises(ValueError) as excinfo:
+            threshold_model.check_bounds("e", "(10, 14.75]")
+        assert "All elements of e must be between (10.0, 14.75]" == str(excinfo.value)
+
+        with pytest.raises(ValueError) as excinfo:
+            threshold_model.check_bounds("e", "[10, 14.75)")
+        assert "All elements of e must be between [10.0, 14.75)" == str(excinfo.value)
+
+    @pytest.mark.parametrize("length", [3, 9])
+    @pytest.mark.parametrize("element", [[0.5, 0.5], None, "a"])
+    def test_threshold_invalid_list_elements(self, threshold_model, length, element):
+        """Checks that short and long lists reject non-numeric elements with
+        the same error.
+        """
+        threshold_model.config["f"] = [element] * length
+        with pytest.raises(TypeError):
+            threshold_model.check_bounds("f", "[0, 1]")
+
     def test_threshold_within_bounds_exclusive_lower(self, threshold_model):
         with not_raises(ValueError):
             # single value
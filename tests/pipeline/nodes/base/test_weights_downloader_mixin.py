@@ -13,15 +13,22 @@
 # limitations under the License.
 
 import hashlib
+import io
+import json
 import logging
+import os
+import stat
 import tempfile
+import zipfile
 from pathlib import Path
 from unittest import TestCase, mock
 
 import pytest
+import requests
 import yaml
 
 from peekingduck.pipeline.nodes.base import (
+    DOWNLOAD_PART_MIN_SIZE,
     PEEKINGDUCK_WEIGHTS_SUBDIR,
     WeightsDownloaderMixin,
 )
@@ -44,6 +51,67 @@ def fixture_weights_type_model(request):
     return WeightsModel(PKD_DIR / "configs" / "model" / f"{request.param}.yml")
 
 
+class FakeResponse:
+    def __init__(self, content, status_code=200, headers=None):
+        self.raw = io.BytesIO(content)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeSession:
+    """Serves `content` for every URL. `range_mode` controls how Range
+    headers are answered:
+    - "ok": the requested range
+    - "ignored": the whole file with status 200
+    - "mismatched": status 206 with a different range
+    - "short": status 206 with the requested range truncated
+    """
+
+    def __init__(self, content, range_mode):
+        self.content = content
+        self.range_mode = range_mode
+        self.range_requests = []
+        self.num_closed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.num_closed += 1
+
+    def head(self, url, **kwargs):
+        headers = {"Content-Length": str(len(self.content))}
+        if self.range_mode != "ignored":
+            headers["Accept-Ranges"] = "bytes"
+        return FakeResponse(b"", headers=headers)
+
+    def get(self, url, headers=None, **kwargs):
+        if headers is None or "Range" not in headers:
+            return FakeResponse(self.content)
+        self.range_requests.append(headers["Range"])
+        if self.range_mode == "ignored":
+            return FakeResponse(self.content)
+        start, end = map(int, headers["Range"][len("bytes=") :].split("-"))
+        if self.range_mode == "mismatched":
+            start, end = start + 1, end + 1
+        content = self.content[start : end + 1]
+        if self.range_mode == "short":
+            content = content[:-1]
+        content_range = f"bytes {start}-{end}/{len(self.content)}"
+        return FakeResponse(
+            content, status_code=206, headers={"Content-Range": content_range}
+        )
+
+
 class WeightsModel(WeightsDownloaderMixin):
     def __init__(self, config_file):
         with open(config_file) as infile:
@@ -152,6 +220,168 @@ class TestWeightsDownloaderMixin:
 
             assert weights_type_model._has_weights(model_dir)
 
+    def test_requests_session_is_reused(self, weights_model):
+        """Checks that the same HTTP session is used for subsequent downloads
+        so the connection to the weights server can be kept alive.
+        """
+        session = weights_model.requests_session
+        assert weights_model.requests_session is session
+
+    @mock.patch.dict(WeightsDownloaderMixin._weights_checksums_cache, clear=True)
+    def test_weights_checksums_fetched_once(self):
+        """Checks that `weights_checksums.json` is only fetched once and
+        shared between model nodes.
+        """
+        config_file = PKD_DIR / "configs" / "model" / "yolox.yml"
+        models = [WeightsModel(config_file), WeightsModel(config_file)]
+        model_format = models[0].config["model_format"]
+        model_type = str(models[0].config["model_type"])
+        checksums = {models[0].model_subdir: {model_format: {model_type: "abc"}}}
+
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch(
+            "requests.Session.get"
+        ) as mock_get:
+            mock_get.return_value.__enter__.return_value.json.return_value = checksums
+            for model in models:
+                model.config["weights_parent_dir"] = tmp_dir
+            assert [model._get_weights_checksum() for model in models] == [
+                "abc",
+                "abc",
+            ]
+            assert mock_get.call_count == 1
+
+    @pytest.mark.parametrize("range_mode", ["ok", "ignored", "mismatched", "short"])
+    def test_download_to(self, weights_type_model, range_mode):
+        """Checks that large files are downloaded correctly when the server
+        supports range requests, and that the whole file is downloaded again
+        when the server ignores the ranges or returns wrong/incomplete ones.
+        """
+        content = os.urandom(2 * DOWNLOAD_PART_MIN_SIZE + 123)
+        session = FakeSession(content, range_mode)
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch(
+            "requests.Session", return_value=session
+        ):
+            weights_type_model._download_to("weights.zip", Path(tmp_dir))
+
+            assert (Path(tmp_dir) / "weights.zip").read_bytes() == content
+        if range_mode == "ignored":
+            assert not session.range_requests
+        else:
+            assert len(session.range_requests) == 2
+
+    def test_download_parts_closes_sessions(self, weights_type_model):
+        """Checks that the session opened for each byte range is closed once
+        the range has been downloaded.
+        """
+        content = os.urandom(2 * DOWNLOAD_PART_MIN_SIZE + 123)
+        session = FakeSession(content, "ok")
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch(
+            "requests.Session", return_value=session
+        ):
+            assert weights_type_model._download_parts(
+                "weights.zip", Path(tmp_dir) / "weights.zip", len(content)
+            )
+        assert len(session.range_requests) == 2
+        assert session.num_closed == 2
+
+    def test_extract_file(self, weights_type_model):
+        """Checks that nested zip members are extracted and that members
+        cannot escape the destination directory.
+        """
+        members = {
+            "model/saved_model.pb": b"graph",
+            "model/variables/variables.index": b"index",
+            "../outside.txt": b"outside",
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            destination_dir = Path(tmp_dir) / "weights"
+            destination_dir.mkdir()
+            zip_path = destination_dir / weights_type_model.blob_filename
+            with zipfile.ZipFile(zip_path, "w") as outfile:
+                for name, content in members.items():
+                    outfile.writestr(name, content)
+
+            weights_type_model._extract_file(destination_dir)
+
+            assert not zip_path.exists()
+            assert not (Path(tmp_dir) / "outside.txt").exists()
+            assert (destination_dir / "outside.txt").read_bytes() == b"outside"
+            for name, content in list(members.items())[:2]:
+                assert (destination_dir / name).read_bytes() == content
+
+    def test_extract_member_outside_destination(self):
+        """Checks that a member which would be written outside the
+        destination directory, here through a symlink, is rejected.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            destination_dir = Path(tmp_dir) / "weights"
+            outside_dir = Path(tmp_dir) / "outside"
+            destination_dir.mkdir()
+            outside_dir.mkdir()
+            (destination_dir / "link").symlink_to(outside_dir)
+            zip_path = Path(tmp_dir) / "weights.zip"
+            with zipfile.ZipFile(zip_path, "w") as outfile:
+                outfile.writestr("link/evil.txt", b"evil")
+
+            with zipfile.ZipFile(zip_path) as infile, pytest.raises(
+                ValueError
+            ) as excinfo:
+                WeightsDownloaderMixin._extract_member(
+                    infile, infile.getinfo("link/evil.txt"), destination_dir
+                )
+            assert "Zip member link/evil.txt is outside of" in str(excinfo.value)
+            assert not (outside_dir / "evil.txt").exists()
+
+    @pytest.mark.parametrize("mmap_min_size", [0, 1 << 30])
+    def test_sha256sum_large_file(self, mmap_min_size):
+        """Checks that memory-mapped and chunked hashing give the same
+        digest.
+        """
+        content = os.urandom(3 * 1024 * 1024 + 7)
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch(
+            "peekingduck.pipeline.nodes.base.SHA256_MMAP_MIN_SIZE", mmap_min_size
+        ):
+            weights_path = Path(tmp_dir) / "weights.pth"
+            weights_path.write_bytes(content)
+            assert (
+                WeightsDownloaderMixin.sha256sum(weights_path).hexdigest()
+                == hashlib.sha256(content).hexdigest()
+            )
+
+    @mock.patch.dict(WeightsDownloaderMixin._weights_checksums_cache, clear=True)
+    def test_weights_checksums_offline(self, weights_type_model):
+        """Checks that the last fetched weights checksums are used when the
+        weights server cannot be reached.
+        """
+        model_format = weights_type_model.config["model_format"]
+        model_type = str(weights_type_model.config["model_type"])
+        checksums = {
+            weights_type_model.model_subdir: {model_format: {model_type: "abc"}}
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir, TestCase.assertLogs(
+            "test_weights_downloader_mixin.WeightsModel"
+        ) as captured, mock.patch(
+            "requests.Session.get", side_effect=requests.ConnectionError
+        ):
+            weights_type_model.config["weights_parent_dir"] = tmp_dir
+            with pytest.raises(requests.ConnectionError):
+                weights_type_model._get_weights_checksum()
+
+            local_path = (
+                Path(tmp_dir) / PEEKINGDUCK_WEIGHTS_SUBDIR / "weights_checksums.json"
+            )
+            local_path.parent.mkdir()
+            local_path.write_text(json.dumps(checksums)[:-1])
+            with pytest.raises(requests.ConnectionError):
+                weights_type_model._get_weights_checksum()
+
+            local_path.write_text(json.dumps(checksums))
+            assert weights_type_model._get_weights_checksum() == "abc"
+            assert captured.records[0].getMessage() == (
+                "Unable to reach weights server, using weights checksums from "
+                f"{local_path}."
+            )
+
     def test_sha256sum_ignores_macos_files(self):
         """Checks that extra files created on Mac OS is ignored by the
         sha256sum() method.
@@ -172,6 +402,48 @@ class TestWeightsDownloaderMixin:
                 == expected.hexdigest()
             )
 
+    def test_cached_sha256_skips_unchanged_weights(self, weights_type_model):
+        """Checks that the weights are only rehashed when their size or
+        modification time changes.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            weights_path = Path(tmp_dir) / "weights.pth"
+            weights_path.write_text("weights")
+            expected = hashlib.sha256(b"weights").hexdigest()
+
+            with mock.patch.object(
+                WeightsDownloaderMixin,
+                "sha256sum",
+                wraps=WeightsDownloaderMixin.sha256sum,
+            ) as mock_sha256sum:
+                assert weights_type_model._cached_sha256(weights_path) == expected
+                assert weights_type_model._cached_sha256(weights_path) == expected
+                assert mock_sha256sum.call_count == 1
+
+                weights_path.write_text("updated weights")
+                assert (
+                    weights_type_model._cached_sha256(weights_path)
+                    == hashlib.sha256(b"updated weights").hexdigest()
+                )
+                assert mock_sha256sum.call_count == 2
+
+    @pytest.mark.skipif(os.name == "nt", reason="POSIX file permissions")
+    def test_write_json_follows_umask(self, weights_type_model):
+        """Checks that JSON files written via a temporary file get the same
+        permissions as files created with open().
+        """
+        old_umask = os.umask(0o022)
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                json_path = Path(tmp_dir) / "weights_checksums.json"
+                weights_type_model._write_json(json_path, {"a": 1})
+
+                assert json.loads(json_path.read_text()) == {"a": 1}
+                assert stat.S_IMODE(json_path.stat().st_mode) == 0o644
+                assert os.listdir(tmp_dir) == ["weights_checksums.json"]
+        finally:
+            os.umask(old_umask)
+
     @pytest.mark.usefixtures("tmp_dir")
     @mock.patch.object(WeightsDownloaderMixin, "_download_to", wraps=do_nothing)
     @mock.patch.object(WeightsDownloaderMixin, "_extract_file", wraps=do_nothing)